@@ -1,9 +1,22 @@
 #!/usr/bin/env python3.5
 import argparse
 import csv
+import hashlib
+import mmap
+import pickle
 import re
-from glob import glob
-from os import path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import StringIO
+from itertools import chain, islice
+from operator import itemgetter
+from os import cpu_count, makedirs, path, scandir, stat
+from queue import Queue
+from shutil import copyfileobj
+from sys import intern
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
 
 # Core script information
 BASE_DIR = path.dirname(path.realpath(__file__))
@@ -16,9 +29,28 @@ COL_DATA_TYPE_TO_PYTHON_TYPE = {
     'ASCII_REAL': float,
     'ASCII_INTEGER': int
 }
-COL_TUPLE_NUM_INDEX, COL_TUPLE_NAME_INDEX, COL_TUPLE_TYPE_INDEX = 0, 1, 2
+WRITE_CHUNK_ROW_COUNT = 16384  # Number of result rows buffered between writerows() calls
+# Tokenizer for the structured .FMT/.LBL files. A single compiled pattern captures, per match,
+# either an END_OBJECT/END_GROUP boundary, an OBJECT/GROUP opening, or a KEY = VALUE pair whose
+# value may be a multiline quoted string or parenthesised tuple. It is compiled as a bytes
+# pattern so it can scan an mmap'd file buffer directly
+TOKEN_RE = re.compile(
+    '(?ms)^\\s*(?:'
+    '(END_(?:{objs}))\\s*(?:=.*?)?$'
+    '|({objs})\\s*=\\s*(\\S+)\\s*$'
+    '|(\\^?[A-Z_][A-Z0-9_:]*)\\s*=\\s*({multi}|[^\\n]+?)\\s*$'
+    ')'.format(
+        objs='|'.join(OBJ_TOKENS),
+        multi='|'.join('{0}[^{1}]*{1}'.format(re.escape(begin_token), re.escape(end_token))
+                       for begin_token, end_token in MULTILINE_TOKENS)).encode('ascii'))
+
+# Single-membership-test form of the MULTILINE_TOKENS begin tokens, derived once at import
+MULTILINE_BEGIN_TOKENS = frozenset(begin_token for begin_token, _ in MULTILINE_TOKENS)
 
 # Default values which are configurable via program input
+CSV_RESULTS_FORMAT = 'csv'
+PARQUET_RESULTS_FORMAT = 'parquet'  # Requires the optional pyarrow package
+DEFAULT_RESULTS_FORMAT = CSV_RESULTS_FORMAT
 DEFAULT_RESULTS_CSV_FILE_NAME = 'results.csv'
 DEFAULT_MAX_ROW_COUNT = -1  # Either supply the maximum row count to write out or -1 to get all
 DEFAULT_TARGET_COL_NAMES = [  # Either supply target col names to source data from or [] to get all
@@ -29,6 +61,15 @@ DEFAULT_TARGET_COL_NAMES = [  # Either supply target col names to source data fr
 # This variable is designed to be configurable
 TARGET_LBL_INFO = []
 
+# Directory in which parsed label files are persisted between runs; label files change rarely, so
+# re-runs can skip straight to the pickled parse results
+DISK_CACHE_DIR = path.join(path.expanduser('~'), '.cache', 'rover-data-processor')
+
+# Version of the parser's output format, mixed into the disk-cache key; bump this whenever the
+# tokenizer or the shape of the parsed results changes so stale pickles from an older parser are
+# treated as misses instead of being served silently
+DISK_CACHE_SCHEMA_VERSION = 1
+
 
 def parse_structured_file(structured_file):
     """
@@ -38,91 +79,97 @@ def parse_structured_file(structured_file):
     In particular, the file types in the project that conform to the format are the .FMT and .LBL
     files.
 
+    Results are memoized on the filepath, size, and modification time — both in process and in an
+    on-disk pickle cache that survives between runs — so repeated parses of an unchanged file are
+    free. Callers must treat the returned dict as read-only.
+
     :param structured_file: Filepath to a file which will be parsed
     :return:                Dict object storing the key -> value mappings represented in the
                             provided 'structured_file'
     """
+    file_stat = stat(structured_file)
+
+    return _parse_structured_file_cached(path.abspath(structured_file),
+                                         file_stat.st_mtime_ns,
+                                         file_stat.st_size)
+
+
+@lru_cache(maxsize=4096)
+def _parse_structured_file_cached(structured_file, mtime_ns, size):
+    """
+    Cached implementation of parse_structured_file; 'mtime_ns' and 'size' only participate in the
+    cache keys so that a modified file is reparsed. On an in-process cache miss the on-disk pickle
+    cache is consulted before falling back to a full parse.
+    """
+    cache_key = hashlib.sha256(
+        '{}:{}:{}:{}'.format(
+            DISK_CACHE_SCHEMA_VERSION, structured_file, mtime_ns, size).encode()).hexdigest()
+    cache_filepath = path.join(DISK_CACHE_DIR, '{}.pkl'.format(cache_key))
+
+    if path.exists(cache_filepath):
+        try:
+            with open(cache_filepath, 'rb') as cache_file:
+                return pickle.load(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass  # Treat an unreadable cache entry as a miss and reparse
+
     structured_file_info = {}
 
-    with open(structured_file, 'r') as f:
-        building_obj = False
-        obj_token = ''
-        obj_key = ''
-        current_obj = {}
-
-        in_multiline = False
-        multiline_end_token = ''
-        multiline_key = ''
-        multiline_value = ''
-
-        for line in f:
-            clean_line = line.strip()
-
-            if building_obj:
-                if in_multiline:
-                    if clean_line and multiline_end_token == clean_line.strip('\n')[-1]:
-                        in_multiline = False
-                        multiline_value += clean_line
-                        current_obj[multiline_key] = multiline_value
-                    else:
-                        multiline_value += clean_line
-                elif clean_line.startswith('END_{}'.format(obj_token)):
-                    if obj_key in structured_file_info:
-                        if not isinstance(structured_file_info[obj_key], list):
-                            first_value = structured_file_info[obj_key]
-                            structured_file_info[obj_key] = []
-                            structured_file_info[obj_key].append(first_value)
-
-                        structured_file_info[obj_key].append(current_obj)
-                    else:
-                        structured_file_info[obj_key] = current_obj
-
-                    building_obj = False
-                    obj_token = ''
-                    current_obj = {}
-                else:
-                    parsed_line = clean_line.split(' = ')
-                    key = parsed_line[0].strip()
-                    value = parsed_line[1].strip()
-
-                    for begin_token, end_token in MULTILINE_TOKENS:
-                        if value[0] == begin_token and (value[-1] != end_token or len(value) == 1):
-                            in_multiline = True
-                            multiline_end_token = end_token
-                            multiline_key = key
-                            multiline_value = value
-                            break
-
-                    if not in_multiline:
-                        current_obj[key] = value.strip('\n')
-            elif in_multiline:
-                if clean_line and multiline_end_token == clean_line.strip('\n')[-1]:
-                    in_multiline = False
-                    multiline_value += clean_line
-                    structured_file_info[multiline_key] = multiline_value
-                else:
-                    multiline_value += clean_line
-            elif ' = ' in clean_line:
-                parsed_line = clean_line.split(' = ')
-                key = parsed_line[0].strip()
-                value = parsed_line[1].strip()
-
-                if key in OBJ_TOKENS:
-                    building_obj = True
-                    obj_token = key
-                    obj_key = value
+    if size == 0:
+        return structured_file_info
+
+    # Tokenize the mmap'd buffer in place, so the scan runs over the page cache with no bulk copy
+    # or upfront decode; only the matched groups are decoded, as latin-1, which maps the PDS byte
+    # values one-for-one and cannot fail on a stray high byte
+    with open(structured_file, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as file_buffer:
+        obj_stack = []  # Stack of (obj_key, obj_dict) frames for the OBJECT/GROUP being built
+
+        for match in TOKEN_RE.finditer(file_buffer):
+            end_token, obj_token, obj_name, key, value = match.groups()
+
+            if obj_token:
+                obj_stack.append((obj_name.decode('latin-1'), {}))
+            elif end_token:
+                if not obj_stack:
+                    continue
+
+                obj_key, current_obj = obj_stack.pop()
+                parent = obj_stack[-1][1] if obj_stack else structured_file_info
+
+                # Single lookup instead of the contains-then-index dance; repeated objects under
+                # the same key (COLUMN blocks) get promoted to a list on the second occurrence
+                existing = parent.get(obj_key)
+
+                if existing is None:
+                    parent[obj_key] = current_obj
+                elif isinstance(existing, list):
+                    existing.append(current_obj)
                 else:
-                    for begin_token, end_token in MULTILINE_TOKENS:
-                        if value[0] == begin_token and (value[-1] != end_token or len(value) == 1):
-                            in_multiline = True
-                            multiline_end_token = end_token
-                            multiline_key = key
-                            multiline_value = value
+                    parent[obj_key] = [existing, current_obj]
+            else:
+                key = key.decode('latin-1')
+                value = value.decode('latin-1')
 
-                            break
+                if value[0] in MULTILINE_BEGIN_TOKENS and '\n' in value:
+                    # Collapse a multiline value the same way the line-by-line parser did, by
+                    # concatenating the stripped lines
+                    value = ''.join(part.strip() for part in value.splitlines())
 
-                    if not in_multiline:
-                        structured_file_info[key] = value.strip('\n')
+                target = obj_stack[-1][1] if obj_stack else structured_file_info
+
+                # Keys and short values repeat heavily across COLUMN objects and label files, so
+                # intern them: duplicate strings collapse to one object and dict lookups on them
+                # become identity compares
+                target[intern(key)] = intern(value) if len(value) < 64 else value
+
+    try:
+        makedirs(DISK_CACHE_DIR, exist_ok=True)
+
+        with open(cache_filepath, 'wb') as cache_file:
+            pickle.dump(structured_file_info, cache_file, pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass  # The disk cache is an optimization only; run on without it if it cannot be written
 
     return structured_file_info
 
@@ -136,11 +183,13 @@ def get_col_info(fmt_file, target_col_names):
     :param fmt_file:         Structured .FMT file
     :param target_col_names: List of the names of the columns for which we want the corresponding
                              column, or an empty list
-    :return:                 A list of tuples containing the target column numbers, names, and
-                             python data types which were extracted according to the target
-                             information
+    :return:                 A tuple of three parallel lists containing the target column numbers,
+                             names, and python data types which were extracted according to the
+                             target information
     """
-    col_info_tuple_list = []
+    col_nums, col_names, col_types = [], [], []
+
+    target_col_name_set = set(target_col_names)
 
     column_definitions = parse_structured_file(fmt_file)['COLUMN']
 
@@ -149,25 +198,15 @@ def get_col_info(fmt_file, target_col_names):
     for column_definition in column_definitions:
         assert isinstance(column_definition, dict)
 
-        if target_col_names:
-            for target_col_name in target_col_names:
-                if column_definition['NAME'] == target_col_name:
-                    col_info_tuple_list.append((
-                        int(column_definition['COLUMN_NUMBER']),
-                        column_definition['NAME'].strip('\"'),
-                        COL_DATA_TYPE_TO_PYTHON_TYPE[column_definition['DATA_TYPE']]
-                    ))
-        else:
-            col_info_tuple_list.append((
-                int(column_definition['COLUMN_NUMBER']),
-                column_definition['NAME'].strip('\"'),
-                COL_DATA_TYPE_TO_PYTHON_TYPE[column_definition['DATA_TYPE']]
-            ))
+        if not target_col_name_set or column_definition['NAME'] in target_col_name_set:
+            col_nums.append(int(column_definition['COLUMN_NUMBER']))
+            col_names.append(intern(column_definition['NAME'].strip('\"')))
+            col_types.append(COL_DATA_TYPE_TO_PYTHON_TYPE[column_definition['DATA_TYPE']])
 
-    assert not target_col_names or (len(target_col_names) == len(col_info_tuple_list)), \
+    assert not target_col_name_set or (len(target_col_name_set) == len(col_nums)), \
         'Not all target col names were found in the supplied label file'
 
-    return col_info_tuple_list
+    return col_nums, col_names, col_types
 
 
 def get_lbl_info(lbl_file_info, target_info):
@@ -183,97 +222,415 @@ def get_lbl_info(lbl_file_info, target_info):
                           to the provided 'target_info'
     """
     target_results = {}
+    # Walk the nested targets with an explicit stack; leaf values land straight in
+    # target_results, with no per-level result dict to build and merge back up
+    pending = [(lbl_file_info, target_info)]
 
-    for target in target_info:
-        if isinstance(target, dict):
-            for key in target.keys():
-                # Merge result dicts
-                target_results = {**target_results,
-                                  **get_lbl_info(lbl_file_info[key], target[key])}
-        else:
-            target_results[target] = lbl_file_info[target]
+    while pending:
+        sub_info, sub_target_info = pending.pop()
+
+        for target in sub_target_info:
+            if isinstance(target, dict):
+                for key in target.keys():
+                    pending.append((sub_info[key], target[key]))
+            else:
+                target_results[target] = sub_info[target]
 
     return target_results
 
 
-def get_sol_from_filepath(filepath):
+def _flatten_target_lbl_keys(target_info):
     """
-    Extract information about the Sol during which data was collected, given a filepath to a data
-    file.
+    Flatten a nested target structure, as held in TARGET_LBL_INFO, down to the leaf keys it
+    selects; these are the keys get_lbl_info produces for a label that satisfies the targets.
 
-    :param filepath: Path to some data file, assumed to match the format
-                     'DATA/SOL_<Start Sol>_<End Sol>/SOL<Sol Number>/<Data File>'
-                     where all sols are represented to five digits
-    :return:         The specific Sol Number in the filepath
+    :param target_info: A data structure representing the target keys, or nested sub-keys
+    :return:            List of the leaf keys selected by 'target_info'
     """
-    expr = re.compile(r'^DATA/SOL_\d{5}_\d{5}/SOL(\d{5})/.*$')
-    return expr.search(filepath).group(1)
+    keys = []
 
+    for target in target_info:
+        if isinstance(target, dict):
+            for sub_target_info in target.values():
+                keys.extend(_flatten_target_lbl_keys(sub_target_info))
+        else:
+            keys.append(target)
 
-def extract_col_value(row, col_info_tuple):
-    """
-    Extracts a particular raw value from a row of data.
+    return keys
 
-    :param row:            Row of data
-    :param col_info_tuple: Tuple containing the number, name, and python type information about the
-                           column
-    :return:               Raw value of the column number provided in 'col_info_tuple' extracted
-                           from 'row'
+
+def enumerate_sols(data_dir='DATA'):
+    """
+    Walk the 'data_dir' tree once with os.scandir, pairing up the .LBL and .TAB files that live in
+    each sol directory. This replaces separate globs for the two file types, which each stat every
+    candidate directory.
+
+    :param data_dir: Directory containing the 'SOL_<Start Sol>_<End Sol>' range directories
+    :return:         Generator of (sol, lbl_filepaths, tab_filepaths) tuples, one per sol
+                     directory, where the sol is the five digit Sol Number taken from the
+                     directory name
     """
-    return row[col_info_tuple[COL_TUPLE_NUM_INDEX] - 1]
+    # A missing data directory simply yields no sols, matching the old glob behavior of
+    # producing no work before the data has been downloaded
+    try:
+        range_entries = sorted(scandir(data_dir), key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return
+
+    # Directory listings are sorted at each level so the walk (and therefore worker submission
+    # and results order) is deterministic regardless of filesystem enumeration order
+    for range_entry in range_entries:
+        if not (range_entry.name.startswith('SOL_')
+                and range_entry.is_dir(follow_symlinks=False)):
+            continue
+
+        for sol_entry in sorted(scandir(range_entry.path), key=lambda entry: entry.name):
+            if not (sol_entry.name.startswith('SOL')
+                    and sol_entry.is_dir(follow_symlinks=False)):
+                continue
+
+            lbl_filepaths, tab_filepaths = [], []
+
+            for data_entry in scandir(sol_entry.path):
+                if data_entry.name.endswith('.LBL'):
+                    lbl_filepaths.append(data_entry.path)
+                elif data_entry.name.endswith('.TAB'):
+                    tab_filepaths.append(data_entry.path)
 
+            lbl_filepaths.sort()
+            tab_filepaths.sort()
 
-def extract_formatted_col_value(row, col_info_tuple):
+            yield sol_entry.name[3:], lbl_filepaths, tab_filepaths
+
+
+def get_sol_from_filepath(filepath):
     """
-    Extracts a particular raw value from a row of data and formats it to be the proper python type
+    Extract information about the Sol during which data was collected, given a filepath to a data
+    file.
 
-    :param row:            Row of data
-    :param col_info_tuple: Tuple containing the number, name, and python type information about the
-                           column
-    :return:               Formatted value of the column number provided in 'col_info_tuple'
-                           extracted from 'row'
+    :param filepath: Path to some data file, assumed to match the format
+                     'DATA/SOL_<Start Sol>_<End Sol>/SOL<Sol Number>/<Data File>'
+                     where all sols are represented to five digits
+    :return:         The specific Sol Number in the filepath
     """
-    return col_info_tuple[COL_TUPLE_TYPE_INDEX](extract_col_value(row, col_info_tuple))
+    # The layout is fixed, so slicing the digits out of the containing directory name beats
+    # running a regex engine per file
+    return path.basename(path.dirname(filepath))[3:8]
 
 
 def compose_custom_rows(results_filepath,
                         data_filepath,
+                        data,
                         remaining_row_count,
-                        col_info_tuple_list,
-                        lbl_info_values):
+                        col_nums,
+                        col_types,
+                        lbl_info_values,
+                        pad_unk_cells=False):
     """
     Writes out data to the file at 'results_filepath' using data from fields corresponding to the
     columns at 'col_nums' and sourced from the file at 'data_filepath' and data that has already
     been sourced from the .LBL file now stored in 'lbl_info_values'
 
     :param results_filepath:    Filepath to the file in which all of the data will be stored
-    :param data_filepath:       Filepath to the .TAB data file
+    :param data_filepath:       Filepath to the .TAB data file, used for error reporting
+    :param data:                Raw bytes of the .TAB data file
     :param remaining_row_count: Number of rows that can still be written out,
                                 i.e. maxRowCount - Number of rows already written out
-    :param col_info_tuple_list: A list of tuples containing the numbers, names, and python data
-                                types of the columns targeted for writing to the csv file
+    :param col_nums:            Numbers of the columns targeted for writing to the csv file
+    :param col_types:           Python data types of the columns, parallel to 'col_nums'
     :param lbl_info_values:     Data sourced from the .LBL file
+    :param pad_unk_cells:       When True, write 'UNK' cells out as empty cells so every row keeps
+                                the full column width, rather than dropping them
     :return:                    The row count remaining after processing the data in 'data_filepath'
                                 i.e. remaining_row_count - number of rows in data_filepath
     """
-    with open(data_filepath, 'r') as data_file, open(results_filepath, 'a') as results_file:
-        csv_writer = csv.writer(results_file)
+    # Gather the target cells of a row with a single C-level itemgetter call instead of indexing
+    # column by column in the interpreter; itemgetter returns a bare value for a single column, so
+    # that case is wrapped to keep the gather result a tuple
+    col_indexes = [col_num - 1 for col_num in col_nums]
+
+    if len(col_indexes) == 1:
+        only_col_index = col_indexes[0]
+        gather = lambda row: (row[only_col_index],)
+    else:
+        gather = itemgetter(*col_indexes)
+
+    # Only split out as many fields as the highest target column requires; the rest of the line
+    # stays an unsplit blob in the final slot, which the gather never touches
+    max_split = max(col_indexes) + 1
+
+    # The label values are identical for every row of the file, so serialize them once, with
+    # csv-compliant quoting, into a ready-to-append suffix string; the row loop then joins the
+    # converted cells and appends the tail without a csv.writer dispatch per row
+    tail_buffer = StringIO()
+    csv.writer(tail_buffer).writerow(lbl_info_values)
+    # Two variants of the tail: one with the separator joining it to the row's data cells, and a
+    # bare one for rows whose target cells were all 'UNK' and dropped, leaving no data cells to
+    # separate from
+    bare_lbl_info_tail = tail_buffer.getvalue()
+    lbl_info_tail = (',' if lbl_info_values else '') + bare_lbl_info_tail
+
+    # The rows are plain comma-separated ASCII, so a bytes.split per line replaces the csv
+    # module's quote-aware state machine and the text codec layer, and the float/int constructors
+    # convert ASCII bytes directly
+    all_lines = data.splitlines()
+
+    # Fail fast if quoting ever shows up in the data
+    assert not all_lines or b'\"' not in all_lines[0], \
+        'Unexpected quoting in .TAB file: {}'.format(data_filepath)
+
+    with open(results_filepath, 'ab', buffering=1 << 20) as results_file:
+        out_lines = []
+        rows_written = 0
+
+        # The row budget is enforced by islice in C, rather than by a compare-and-decrement
+        # executed for every row
+        lines = all_lines if remaining_row_count < 0 else islice(all_lines, remaining_row_count)
+
+        for line in lines:
+            raw_values = gather(line.split(b',', max_split))
+
+            if pad_unk_cells:
+                col_values = [None if raw_value.strip() == b'UNK' else col_type(raw_value)
+                              for raw_value, col_type in zip(raw_values, col_types)]
+            else:
+                col_values = [col_type(raw_value)
+                              for raw_value, col_type in zip(raw_values, col_types)
+                              if raw_value.strip() != b'UNK']
+
+            if col_values:
+                out_lines.append(
+                    ','.join('' if col_value is None else str(col_value)
+                             for col_value in col_values)
+                    + lbl_info_tail)
+            else:
+                out_lines.append(bare_lbl_info_tail)
+
+            if len(out_lines) >= WRITE_CHUNK_ROW_COUNT:
+                results_file.write(''.join(out_lines).encode('utf-8'))
+                rows_written += len(out_lines)
+                out_lines.clear()
+
+        results_file.write(''.join(out_lines).encode('utf-8'))
+        rows_written += len(out_lines)
+
+    if remaining_row_count > 0:
+        remaining_row_count -= rows_written
+
+    return remaining_row_count
+
+
+def _prefetch_tab_files(tab_filepaths, prefetch_queue, stop_event):
+    """
+    Reader-thread target: loads each .TAB file's bytes and feeds them through 'prefetch_queue' so
+    the next file's I/O overlaps the row processing of the current one. A None sentinel marks the
+    end of the stream; 'stop_event' aborts the remaining reads early. A failed read is put on the
+    queue as the exception itself, for the consumer to re-raise; the sentinel still follows, so
+    the consumer can never block forever on a dead reader.
+
+    :param tab_filepaths:  Filepaths of the .TAB data files to read, in order
+    :param prefetch_queue: Bounded queue onto which (tab_filepath, data) tuples are put
+    :param stop_event:     Event signalling that no further files are needed
+    :return:               None
+    """
+    try:
+        for tab_filepath in tab_filepaths:
+            if stop_event.is_set():
+                break
+
+            with open(tab_filepath, 'rb', buffering=1 << 20) as tab_file:
+                prefetch_queue.put((tab_filepath, tab_file.read()))
+    except Exception as read_error:
+        prefetch_queue.put(read_error)
+    finally:
+        prefetch_queue.put(None)
+
+
+def _process_sol(task):
+    """
+    Worker for the process pool: writes all of the rows for one sol into its own csv shard, which
+    the parent process later concatenates into the results file. A prefetch thread reads the next
+    .TAB file while the current one's rows are being composed.
+
+    :param task: Tuple of (sol, tab_filepaths, shard_dir, max_row_count, col_nums, col_types,
+                 lbl_info_values, pad_unk_cells) describing the work for one sol
+    :return:     Filepath of the csv shard that was written
+    """
+    (sol, tab_filepaths, shard_dir, max_row_count, col_nums, col_types, lbl_info_values,
+     pad_unk_cells) = task
+
+    shard_filepath = path.join(shard_dir, 'SOL{}.csv'.format(sol))
+    remaining_row_count = max_row_count
+
+    prefetch_queue = Queue(maxsize=2)
+    stop_event = Event()
+    reader = Thread(target=_prefetch_tab_files,
+                    args=(tab_filepaths, prefetch_queue, stop_event),
+                    daemon=True)
+    reader.start()
+
+    while True:
+        prefetched = prefetch_queue.get()
+
+        if prefetched is None:
+            break
+
+        if isinstance(prefetched, Exception):
+            # A read failed; surface it here so the run fails with a traceback instead of
+            # silently truncating this sol's rows
+            reader.join()
+            raise prefetched
+
+        tab_filepath, tab_data = prefetched
+
+        print('Calculating rows for sol {}...'.format(sol))
+
+        remaining_row_count = compose_custom_rows(shard_filepath,
+                                                  tab_filepath,
+                                                  tab_data,
+                                                  remaining_row_count,
+                                                  col_nums,
+                                                  col_types,
+                                                  lbl_info_values,
+                                                  pad_unk_cells)
+
+        if remaining_row_count == 0:
+            # Stop the reader and drain what it already queued so it can run to completion
+            stop_event.set()
+
+            while prefetch_queue.get() is not None:
+                pass
+
+            break
+
+    reader.join()
+
+    return shard_filepath
+
+
+def _append_shard(results_file, shard_filepath, remaining_row_count):
+    """
+    Append a worker's csv shard to the results file, honoring the maximum row count.
+
+    :param results_file:        Open handle of the file in which all of the data will be stored
+    :param shard_filepath:      Filepath of the csv shard produced by a worker
+    :param remaining_row_count: Number of rows that can still be written out, or -1 for no limit
+    :return:                    The row count remaining after appending the shard
+    """
+    # The shard is concatenated as raw bytes, with no decode/encode round trip through a text
+    # layer; shard rows never embed newlines (multiline label values are collapsed at parse
+    # time), so the capped path can count plain lines
+    with open(shard_filepath, 'rb', buffering=1 << 20) as shard_file:
+        if remaining_row_count < 0:
+            copyfileobj(shard_file, results_file)
+        else:
+            for line in shard_file:
+                if remaining_row_count == 0:
+                    break
 
-        for row in csv.reader(data_file):
-            if remaining_row_count == 0:
-                return remaining_row_count
-            elif remaining_row_count > 0:
                 remaining_row_count -= 1
+                results_file.write(line)
+
+    return remaining_row_count
+
+
+def _iter_sol_tasks(shard_dir, max_row_count, col_nums, col_types, pad_unk_cells):
+    """
+    Generate one _process_sol task per sol directory, parsing each sol's label on the way. Tasks
+    hold only the filtered label values, never the parsed label dicts, and because the generator
+    is consumed through a bounded submission window only a handful of tasks exist at once, never
+    an archive-wide mapping.
+
+    :param shard_dir:     Directory in which the workers will write their csv shards
+    :param max_row_count: Maximum number of rows any single shard may contain, or -1 for no limit
+    :param col_nums:      Numbers of the columns targeted for writing to the results file
+    :param col_types:     Python data types of the columns, parallel to 'col_nums'
+    :param pad_unk_cells: Whether workers should pad 'UNK' cells to keep the full column width
+    :return:              Generator of (task, sorted_lbl_keys) tuples, where the task is the
+                          argument tuple for _process_sol and 'sorted_lbl_keys' names the label
+                          columns in the order their values appear in the task
+    """
+    # The key set every label yields is fixed by TARGET_LBL_INFO, so the canonical column order
+    # is derived once up front; a per-label sort only happens if some label's keys ever diverge
+    sorted_lbl_keys = sorted(set(_flatten_target_lbl_keys(TARGET_LBL_INFO)))
+    lbl_key_set = frozenset(sorted_lbl_keys)
+
+    for sol, lbl_filepaths, tab_filepaths in enumerate_sols():
+        if not tab_filepaths:
+            continue
+
+        lbl_info = {}
+
+        for lbl_filepath in lbl_filepaths:
+            lbl_info = get_lbl_info(parse_structured_file(lbl_filepath), TARGET_LBL_INFO)
+
+        if lbl_key_set != lbl_info.keys():
+            sorted_lbl_keys = sorted(lbl_info)
+            lbl_key_set = frozenset(lbl_info)
+
+        lbl_info_values = [lbl_info[key] for key in sorted_lbl_keys]
+
+        yield ((sol, tab_filepaths, shard_dir, max_row_count, col_nums, col_types,
+                lbl_info_values, pad_unk_cells), sorted_lbl_keys)
 
-            csv_writer.writerow([
-                *[extract_formatted_col_value(row, col_info_tuple) for col_info_tuple in
-                  col_info_tuple_list if extract_col_value(row, col_info_tuple).strip() != 'UNK'],
-                *lbl_info_values
-            ])
+
+def _append_shard_parquet(parquet_writer, shard_filepath, remaining_row_count):
+    """
+    Append a worker's csv shard to the parquet results file, honoring the maximum row count.
+
+    :param parquet_writer:      Open pyarrow.parquet.ParquetWriter for the results file
+    :param shard_filepath:      Filepath of the csv shard produced by a worker
+    :param remaining_row_count: Number of rows that can still be written out, or -1 for no limit
+    :return:                    The row count remaining after appending the shard
+    """
+    from pyarrow import csv as pyarrow_csv
+
+    # A sol whose .TAB files were all empty produces a zero-byte shard, which pyarrow's csv
+    # reader rejects; there is nothing to append, so skip it
+    if path.getsize(shard_filepath) == 0:
+        return remaining_row_count
+
+    # Empty cells are 'UNK' cells that were padded out by the workers; surface them as nulls
+    table = pyarrow_csv.read_csv(
+        shard_filepath,
+        read_options=pyarrow_csv.ReadOptions(column_names=parquet_writer.schema.names),
+        convert_options=pyarrow_csv.ConvertOptions(column_types=parquet_writer.schema,
+                                                   strings_can_be_null=True))
+
+    if remaining_row_count >= 0:
+        table = table.slice(0, remaining_row_count)
+        remaining_row_count -= table.num_rows
+
+    parquet_writer.write_table(table)
 
     return remaining_row_count
 
 
+def _map_bounded(executor, fn, tasks, max_pending):
+    """
+    Map 'fn' over 'tasks' on 'executor', yielding results in submission order like Executor.map,
+    but pulling tasks from the iterable only as submission slots free up. Executor.map consumes
+    its whole input at submission time, which would materialize every task up front and defeat
+    the lazy task generator.
+
+    :param executor:    Executor on which the tasks are run
+    :param fn:          Callable applied to each task
+    :param tasks:       Iterable of task arguments, consumed lazily
+    :param max_pending: Maximum number of tasks submitted but not yet yielded
+    :return:            Generator of results, in submission order
+    """
+    pending = deque()
+
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
 def main():
     """
     Main method
@@ -294,53 +651,85 @@ def main():
                         default=DEFAULT_TARGET_COL_NAMES,
                         nargs='*',
                         help='Name(s) of the columns to include in the resulting csv')
+    parser.add_argument('-t', '--resultsFormat',
+                        default=DEFAULT_RESULTS_FORMAT,
+                        choices=[CSV_RESULTS_FORMAT, PARQUET_RESULTS_FORMAT],
+                        help=('Format of the results file; the parquet format requires the '
+                              'pyarrow package'))
 
     args = parser.parse_args()
 
-    col_info_tuple_list = get_col_info(TARGET_FMT_FILE, args.targetColNames)
-
-    sol_to_acq_lbl_info = {}
-
-    for filepath in glob('DATA/SOL_?????_?????/SOL?????/*.LBL'):
-        sol_to_acq_lbl_info[get_sol_from_filepath(filepath)] = \
-            get_lbl_info(parse_structured_file(filepath), TARGET_LBL_INFO)
-
-    header_is_written = False
-    remaining_row_count = args.maxRowCount
-
-    for filepath in glob('DATA/SOL_?????_?????/SOL?????/*.TAB'):
-        sol = get_sol_from_filepath(filepath)
-
-        print('Calculating rows for sol {}...'.format(sol))
-
-        lbl_info = sol_to_acq_lbl_info[sol]
-
-        lbl_info_keys, lbl_info_values = [], []
-
-        for key in sorted(lbl_info):
-            lbl_info_keys.append(key)
-            lbl_info_values.append(lbl_info[key])
-
-        if not header_is_written:
-            with open(args.resultsFileName, 'w') as f:
-                csv_writer = csv.writer(f)
-
-                csv_writer.writerow([
-                    *map(lambda col_info_tuple: col_info_tuple[COL_TUPLE_NAME_INDEX],
-                         col_info_tuple_list),
-                    *lbl_info_keys
-                ])
-
-            header_is_written = True
-
-        remaining_row_count = compose_custom_rows(args.resultsFileName,
-                                                  filepath,
-                                                  remaining_row_count,
-                                                  col_info_tuple_list,
-                                                  lbl_info_values)
-
-        if remaining_row_count == 0:
-            break
+    col_nums, col_names, col_types = get_col_info(TARGET_FMT_FILE, args.targetColNames)
+
+    with TemporaryDirectory() as shard_dir:
+        sol_tasks = _iter_sol_tasks(shard_dir,
+                                    args.maxRowCount,
+                                    col_nums,
+                                    col_types,
+                                    args.resultsFormat == PARQUET_RESULTS_FORMAT)
+
+        # Peel off the first task to learn the label columns for the header, then chain it back
+        # in front of the still-lazy remainder
+        first_sol_task = next(sol_tasks, None)
+
+        if first_sol_task is None:
+            return
+
+        header_row = [*col_names, *first_sol_task[1]]
+        tasks = chain([first_sol_task[0]], (task for task, _ in sol_tasks))
+
+        remaining_row_count = args.maxRowCount
+
+        # Keep enough tasks in flight to saturate the pool while leaving the rest of the sol
+        # walk (label parses included) unconsumed until a slot frees up
+        max_pending_tasks = 2 * (cpu_count() or 1)
+
+        # Each worker is given the full row budget since no single shard may exceed it; the
+        # global cap is enforced while the shards are concatenated, in submission order, so the
+        # output matches a sequential run
+        if args.resultsFormat == PARQUET_RESULTS_FORMAT:
+            try:
+                import pyarrow
+                from pyarrow import parquet as pyarrow_parquet
+            except ImportError:
+                raise SystemExit(
+                    'The {} results format requires the pyarrow package'.format(
+                        PARQUET_RESULTS_FORMAT))
+
+            schema = pyarrow.schema(
+                [(col_name, pyarrow.float64() if col_type is float else pyarrow.int64())
+                 for col_name, col_type in zip(col_names, col_types)]
+                + [(lbl_info_key, pyarrow.string())
+                   for lbl_info_key in header_row[len(col_names):]])
+
+            with pyarrow_parquet.ParquetWriter(args.resultsFileName, schema,
+                                               compression='zstd') as parquet_writer, \
+                    ProcessPoolExecutor() as executor:
+                for shard_filepath in _map_bounded(executor, _process_sol, tasks,
+                                                   max_pending_tasks):
+                    remaining_row_count = _append_shard_parquet(parquet_writer,
+                                                                shard_filepath,
+                                                                remaining_row_count)
+
+                    if remaining_row_count == 0:
+                        break
+        else:
+            # One binary handle, opened once, serves the header and every shard append, so the
+            # large write buffer stays hot for the entire run
+            with open(args.resultsFileName, 'wb', buffering=1 << 20) as results_file, \
+                    ProcessPoolExecutor() as executor:
+                header_buffer = StringIO()
+                csv.writer(header_buffer).writerow(header_row)
+                results_file.write(header_buffer.getvalue().encode('utf-8'))
+
+                for shard_filepath in _map_bounded(executor, _process_sol, tasks,
+                                                   max_pending_tasks):
+                    remaining_row_count = _append_shard(results_file,
+                                                        shard_filepath,
+                                                        remaining_row_count)
+
+                    if remaining_row_count == 0:
+                        break
 
 
 if __name__ == '__main__':